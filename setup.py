@@ -19,6 +19,9 @@ setup(
     install_requires=[
         'paramiko>=3.4.0'
     ],
+    extras_require={
+        're2': ['google-re2']
+    },
     zip_safe=False,
     long_description=long_description,
     long_description_content_type='text/markdown'
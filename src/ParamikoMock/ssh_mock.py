@@ -1,7 +1,93 @@
 from abc import abstractmethod, ABC
+from collections import Counter
+from functools import lru_cache
 from io import StringIO
 import re
-from paramiko.ssh_exception import BadHostKeyException, NoValidConnectionsError
+
+@lru_cache(maxsize=1024)
+def _hostkey(host, port):
+    return f'{host}:{port}'
+
+def _literal_prefix(expression):
+    # Leading plain characters every command matched by the expression starts with
+    if '|' in expression:
+        return ''
+    end = 0
+    while end < len(expression) and expression[end] not in '.^$*+?{}[]\\|()':
+        end += 1
+    if end < len(expression) and expression[end] in '*?{':
+        # the last character can be repeated zero times
+        end = max(end - 1, 0)
+    return expression[:end]
+
+# Expressions that only keep their meaning on their own: numbered
+# backreferences and conditionals, and global inline flags
+_STANDALONE_EXPRESSION = re.compile(r'\\[1-9]|\(\?\([1-9]|^\(\?[aiLmsux]+\)')
+
+def _is_regex_command(command_key):
+    return command_key.startswith('re(') and command_key.endswith(')')
+
+def _compile_regex_responses(regex_items, use_re2=False):
+    # Join the re(...) commands into alternations so one match call finds the
+    # first regexp that applies, the named group tells which one. Expressions
+    # that can not be joined are matched on their own, keeping the order.
+    # The literal prefixes let commands that can not match skip the regexp.
+    stages = []
+    prefixes = []
+    joinable = False
+    group_names = set()
+    for command_key, response in regex_items:
+        expression = command_key[3:-1]
+        prefixes.append(_literal_prefix(expression))
+        names = re.compile(expression).groupindex.keys()
+        standalone = _STANDALONE_EXPRESSION.search(expression) is not None
+        if standalone or not joinable or names & group_names:
+            stages.append(([], set()))
+        stages[-1][0].append((expression, response))
+        group_names = stages[-1][1]
+        group_names.update(names)
+        joinable = not standalone
+    regex_responses = []
+    for stage, group_names in stages:
+        if len(stage) == 1:
+            expression, response = stage[0]
+            regex_responses.append((_compile_pattern(expression, use_re2), response))
+        else:
+            groups = {}
+            expressions = []
+            for expression, response in stage:
+                group_name = _free_group_name(len(groups), group_names)
+                groups[group_name] = response
+                expressions.append(f'(?P<{group_name}>{expression})')
+            regex_responses.append((_compile_pattern('|'.join(expressions), use_re2), groups))
+    return regex_responses, tuple(prefixes)
+
+def _free_group_name(index, group_names):
+    # Group name for a joined expression that the expressions do not use
+    group_name = f'_re{index}'
+    while group_name in group_names:
+        group_name = f'_{group_name}'
+    return group_name
+
+def _compile_pattern(expression, use_re2):
+    # Use RE2 when enabled, expressions it does not support (backreferences,
+    # lookarounds...) fall back to the re module
+    if use_re2:
+        # optional, only imported once use_re2 is enabled
+        try:
+            import re2
+        except ImportError:
+            re2 = None
+        if re2 is None or not hasattr(re2, 'Options'):
+            # pyre2 and fb-re2 install a re2 module too, only google-re2 is supported
+            raise ImportError('use_re2 requires the google-re2 package')
+        options = re2.Options()
+        options.log_errors = False
+        try:
+            return re2.compile(expression, options)
+        except re2.error:
+            pass
+    return re.compile(expression)
 
 # Singleton
 class SingletonMeta(type):
@@ -37,9 +123,14 @@ class SFTPClientMock():
 class SSHClientMock():
     sftp_client_mock = SFTPClientMock()
     called = []
+    called_count = Counter()
+
     def __init__(self, *args, **kwds):
         self.selected_host = None
         self.command_responses = {}
+        self.regex_responses = []
+        self.regex_prefixes = ()
+        self.responses_size = 0
     
     def load_system_host_keys(self):
         pass
@@ -51,39 +142,61 @@ class SSHClientMock():
         return self.sftp_client_mock
     
     def connect(self, host, port, username, password, banner_timeout):
-        self.selected_host = f'{host}:{port}'
-        if self.selected_host not in SSHMockEnvron().commands_response:
-            raise BadHostKeyException(host, None, 'No valid responses for this host')
-        set_credentials = SSHMockEnvron().router_credentials.get(self.selected_host)
+        self.selected_host = _hostkey(host, port)
+        try:
+            command_responses = _environ.commands_response[self.selected_host]
+        except KeyError:
+            # paramiko is only imported when a connection fails
+            from paramiko.ssh_exception import BadHostKeyException
+            raise BadHostKeyException(host, None, 'No valid responses for this host') from None
+        set_credentials = _environ.router_credentials.get(self.selected_host)
         if set_credentials is not None:
             if set_credentials != (username, password):
+                from paramiko.ssh_exception import BadHostKeyException
                 raise BadHostKeyException(host, None, 'Invalid credentials')
-        self.command_responses = SSHMockEnvron().commands_response[self.selected_host]
+        self.command_responses = command_responses
+        self._load_regex_responses()
         self.clear_called_commands()
 
     def clear_called_commands(self):
         self.called.clear()
+        self.called_count.clear()
     
     def exec_command(self, command):
         if self.selected_host is None:
+            from paramiko.ssh_exception import NoValidConnectionsError
             raise NoValidConnectionsError('No valid connections')
         self.called.append(command)
+        self.called_count[command] += 1
         response = self.command_responses.get(command)
         if response is None:
-            # check if there is a command that can be used as regexp
-            for command_key in self.command_responses:
-                if command_key.startswith('re(') and command_key.endswith(')'):
-                    regexp_exp = command_key[3:-1]
-                    if re.match(regexp_exp, command):
-                        response = self.command_responses[command_key]
+            if len(self.command_responses) != self.responses_size:
+                # commands were added to the host after connecting
+                self._load_regex_responses()
+            # check if there is a command that can be used as regexp,
+            # hosts without regexp commands skip this entirely
+            if self.regex_responses and command.startswith(self.regex_prefixes):
+                for pattern, regex_response in self.regex_responses:
+                    match = pattern.match(command)
+                    if match is not None:
+                        # joined expressions are told apart by their named group
+                        if type(regex_response) is dict:
+                            regex_response = regex_response[match.lastgroup]
+                        response = regex_response
                         break
             if response is None:
                 raise NotImplementedError('No valid response for this command')
         return response(self, command)
+
+    def _load_regex_responses(self):
+        self.regex_responses, self.regex_prefixes = _environ._get_regex_responses(self.selected_host, self.command_responses)
+        self.responses_size = len(self.command_responses)
     
     def close(self):
-        self.selected_commands = None
         self.command_responses = {}
+        self.regex_responses = []
+        self.regex_prefixes = ()
+        self.responses_size = 0
 
 class SSHResponseMock(ABC):
     @abstractmethod
@@ -93,15 +206,47 @@ class SSHResponseMock(ABC):
 class SSHMockEnvron(metaclass=SingletonMeta):
     def __init__(self):
         self.commands_response = {}
+        self.regex_responses = {}
         self.router_credentials = {}
+        # match the re(...) commands with google-re2, see the README for the differences
+        self.use_re2 = False
     
     def add_responses_for_host(self, host, port, responses: dict[str, SSHResponseMock], username=None, password=None):
-        self.commands_response[f'{host}:{port}'] = responses
+        host_key = _hostkey(host, port)
+        self.commands_response[host_key] = responses
+        # compile the re(...) commands again, even for the same dict, so
+        # replaced entries are picked up and invalid expressions fail here
+        self.regex_responses.pop(host_key, None)
+        self._get_regex_responses(host_key, responses)
         if username and password:
-            self.router_credentials[f'{host}:{port}'] = (username, password)
+            self.router_credentials[host_key] = (username, password)
+
+    def remove_responses_for_host(self, host, port):
+        host_key = _hostkey(host, port)
+        self.commands_response.pop(host_key, None)
+        self.regex_responses.pop(host_key, None)
+        self.router_credentials.pop(host_key, None)
+
+    def _get_regex_responses(self, host_key, responses):
+        # The compiled re(...) commands of a host are reused while its
+        # responses dict keeps the same size, commands added to the dict
+        # make it compile again. Replacing an re(...) entry in place needs
+        # add_responses_for_host to be called again.
+        state = (len(responses), self.use_re2)
+        compiled = self.regex_responses.get(host_key)
+        if compiled is None or compiled[0] is not responses or compiled[1] != state:
+            regex_items = [(command_key, response) for command_key, response in responses.items() if _is_regex_command(command_key)]
+            compiled = self.regex_responses[host_key] = (responses, state, *_compile_regex_responses(regex_items, self.use_re2))
+        return compiled[2], compiled[3]
     
     def cleanup_environment(self):
+        # rebind instead of clearing, the old tables are dropped as a whole
         self.commands_response = {}
+        self.regex_responses = {}
+        self.router_credentials = {}
+
+# SSHMockEnvron is a singleton, resolve it once for the client mocks
+_environ = SSHMockEnvron()
 
 class SSHCommandMock(SSHResponseMock):
     def __init__(self, stdin, stdout, stderr):
@@ -109,11 +254,22 @@ class SSHCommandMock(SSHResponseMock):
         self.stdout = stdout
         self.stderr = stderr
 
+    @property
+    def stdout(self):
+        # appended chunks are only joined when the output is needed
+        if len(self._stdout_chunks) > 1:
+            self._stdout_chunks = [''.join(self._stdout_chunks)]
+        return self._stdout_chunks[0]
+
+    @stdout.setter
+    def stdout(self, stdout):
+        self._stdout_chunks = [stdout]
+
     def __call__(self, ssh_client_mock: SSHClientMock, command:str) -> tuple[StringIO, StringIO, StringIO]:
         return StringIO(self.stdin), StringIO(self.stdout), StringIO(self.stderr)
 
     def append_to_stdout(self, new_stdout):
-        self.stdout += new_stdout
+        self._stdout_chunks.append(new_stdout)
     
     def remove_line_containing(self, line):
         self.stdout = '\n'.join([x for x in self.stdout.split('\n') if line not in x])
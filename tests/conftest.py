@@ -0,0 +1,87 @@
+import paramiko
+import pytest
+from io import StringIO
+from src.ParamikoMock.ssh_mock import SSHClientMock, SSHCommandMock, SSHMockEnvron, SSHCommandFunctionMock
+
+@pytest.fixture(autouse=True, scope="session")
+def _patch_ssh_client():
+    # patch the paramiko.SSHClient with the mock once for the whole session,
+    # the monkeypatch fixture itself is function scoped
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(paramiko, 'SSHClient', SSHClientMock)
+        yield
+
+# We can also use a custom command processor
+def custom_command_processor(ssh_client_mock: SSHClientMock, command: str):
+    # Parse the command and do something with it
+    if 'param1' in command and 'value1' in command:
+        return StringIO(), StringIO('value1'), StringIO()
+
+# Responses shared by the example hosts, built once
+LS_MOCK = SSHCommandMock('', 'ls output', '')
+DOCKER_PS_MOCK = SSHCommandMock('', 'docker-ps-output', '')
+CUSTOM_COMMAND_MOCK = SSHCommandFunctionMock(custom_command_processor)
+
+SOME_HOST_RESPONSES = {
+    'ls -l': LS_MOCK,
+    're(ls.*)': LS_MOCK
+}
+
+SOME_HOST_2_RESPONSES = {
+    'sudo docker ps': DOCKER_PS_MOCK
+}
+
+# You can use a regexp expresion to match the command with the custom processor
+SOME_HOST_3_RESPONSES = {
+    r're(custom_command .*)': CUSTOM_COMMAND_MOCK # This is a regexp command
+}
+
+SOME_HOST_4_RESPONSES = {
+    'ls -l': LS_MOCK
+}
+
+def _register_example_hosts(environ):
+    environ.add_responses_for_host('some_host', 22, SOME_HOST_RESPONSES, 'root', 'root')
+    environ.add_responses_for_host('some_host_2', 4826, SOME_HOST_2_RESPONSES, 'root', 'root')
+    environ.add_responses_for_host('some_host_3', 22, SOME_HOST_3_RESPONSES, 'root', 'root')
+    environ.add_responses_for_host('some_host_4', 22, SOME_HOST_4_RESPONSES, 'root', 'root')
+
+# The hosts used by the example functions are registered once per session
+@pytest.fixture(scope="session")
+def mock_environ():
+    environ = SSHMockEnvron()
+    _register_example_hosts(environ)
+    yield environ
+    environ.cleanup_environment()
+
+# For tests that clean the environment up, the example hosts are registered again afterwards
+@pytest.fixture
+def cleaned_environ(mock_environ):
+    yield mock_environ
+    _register_example_hosts(mock_environ)
+
+# Hosts registered by a single test are removed again after it
+@pytest.fixture
+def register_host():
+    environ = SSHMockEnvron()
+    registered = set()
+    def register(host, port, responses, username=None, password=None):
+        environ.add_responses_for_host(host, port, responses, username, password)
+        registered.add((host, port))
+    yield register
+    for host, port in registered:
+        environ.remove_responses_for_host(host, port)
+
+@pytest.fixture
+def sftp_file_mock(mock_environ):
+    return SSHClientMock.sftp_client_mock.sftp_file_mock
+
+@pytest.fixture(autouse=True)
+def _reset_client_mocks():
+    # the call history and the SFTP file mock are shared by every client mock,
+    # reset them after each test even when it fails
+    yield
+    SSHClientMock().clear_called_commands()
+    file_mock = SSHClientMock.sftp_client_mock.sftp_file_mock
+    file_mock.written.clear()
+    file_mock.file_content = None
@@ -1,70 +1,61 @@
 import paramiko
-from io import StringIO
-from src.ParamikoMock.ssh_mock import SSHClientMock, SSHCommandMock, SSHMockEnvron, SSHCommandFunctionMock, SFTPFileMock
-from unittest.mock import patch
+import pytest
+from unittest import mock
+from paramiko.ssh_exception import BadHostKeyException
+from src.ParamikoMock.ssh_mock import SSHClientMock, SSHCommandMock, SSHMockEnvron
 
-def example_function_1():
+_POLICY = paramiko.AutoAddPolicy()
+# SSHMockEnvron is a singleton, resolve it once for the tests
+_ENVIRON = SSHMockEnvron()
+
+# host key loading is not part of the mock contract, the helpers skip it
+def _connect(host, port, username='root', password='root'):
     client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.set_missing_host_key_policy(_POLICY)
     # Some example of connection
-    client.connect('some_host',
-                    port=22,
-                    username='root',
-                    password='root',
+    client.connect(host,
+                    port=port,
+                    username=username,
+                    password=password,
                     banner_timeout=10)
-    stdin, stdout, stderr = client.exec_command('ls -l')
+    return client
+
+_CLIENT_CACHE = {}
+
+def _get_client(host, port, username='root', password='root'):
+    # connect once per host and credentials and reuse the client for the next commands
+    key = (host, port, username, password)
+    client = _CLIENT_CACHE.get(key)
+    if client is None:
+        client = _CLIENT_CACHE[key] = _connect(host, port, username, password)
+    return client
+
+@pytest.fixture(autouse=True)
+def _clear_client_cache():
+    # a cached client keeps the tables it connected with, drop it after the test
+    yield
+    _CLIENT_CACHE.clear()
+
+def _run(host, port, command, **credentials):
+    stdin, stdout, stderr = _get_client(host, port, **credentials).exec_command(command)
     return stdout.read()
 
+def example_function_1():
+    return _run('some_host', 22, 'ls -l')
+
 def example_function_2():
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    # Some example of connection
-    client.connect('some_host_2',
-                    port=4826,
-                    username='root',
-                    password='root',
-                    banner_timeout=10)
-    stdin, stdout, stderr = client.exec_command('sudo docker ps')
-    return stdout.read()
+    return _run('some_host_2', 4826, 'sudo docker ps')
 
 def example_function_3():
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    # Some example of connection
-    client.connect('some_host_3',
-                    port=22,
-                    username='root',
-                    password='root',
-                    banner_timeout=10)
-    stdin, stdout, stderr = client.exec_command('custom_command --param1 value1')
-    return stdout.read()
+    return _run('some_host_3', 22, 'custom_command --param1 value1')
 
 def example_function_multiple_calls():
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    # Some example of connection
-    client.connect('some_host',
-                    port=22,
-                    username='root',
-                    password='root',
-                    banner_timeout=10)
+    client = _get_client('some_host', 22)
     client.exec_command('ls -l')
     client.exec_command('ls -al')
 
 def example_function_sftp_write():
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    # Some example of connection
-    client.connect('some_host_4',
-                    port=22,
-                    username='root',
-                    password='root',
-                    banner_timeout=10)
+    client = _connect('some_host_4', 22)
     # Some example of a remote file write
     sftp = client.open_sftp()
     file = sftp.open('/tmp/afileToWrite.txt', 'w')
@@ -73,15 +64,7 @@ def example_function_sftp_write():
     sftp.close()
 
 def example_function_sftp_read():
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    # Some example of connection
-    client.connect('some_host_4',
-                    port=22,
-                    username='root',
-                    password='root',
-                    banner_timeout=10)
+    client = _connect('some_host_4', 22)
     # Some example of a remote file write
     sftp = client.open_sftp()
     file = sftp.open('/tmp/afileToRead.txt', 'r')
@@ -90,70 +73,162 @@ def example_function_sftp_read():
     sftp.close()
     return output
 
-def test_example_function_1():
-    SSHMockEnvron().add_responses_for_host('some_host', 22, {
+@pytest.mark.parametrize('example_function, expected', [
+    (example_function_1, 'ls output'),
+    (example_function_2, 'docker-ps-output'),
+    (example_function_3, 'value1')
+])
+def test_example_function(mock_environ, example_function, expected):
+    assert example_function() == expected
+
+def test_example_function_verify_commands_were_called(mock_environ):
+    example_function_multiple_calls()
+    assert 'ls -l' == SSHClientMock.called[0]
+    assert 'ls -al' == SSHClientMock.called[1]
+    assert SSHClientMock.called_count['ls -l'] == 1
+    assert SSHClientMock.called_count['ls'] == 0
+
+def test_example_function_sftp_write(sftp_file_mock):
+    example_function_sftp_write()
+    assert 'Something to put in the remote file' == sftp_file_mock.written[0]
+
+def test_example_function_sftp_read(sftp_file_mock):
+    sftp_file_mock.file_content = 'Something from the remote file'
+    output = example_function_sftp_read()
+    assert 'Something from the remote file' == output
+
+def test_multiple_regexp_commands(register_host):
+    register_host('regexp_order_host', 22, {
+        r're(other_command .*)': SSHCommandMock('', 'other output', ''),
+        r're(custom_command (--\w+) .*)': SSHCommandMock('', 'first output', ''),
+        r're(custom_command .*)': SSHCommandMock('', 'second output', '')
+    }, 'root', 'root')
+    output = _run('regexp_order_host', 22, 'custom_command --param1 value1')
+    assert output == 'first output'
+
+@pytest.mark.parametrize('host, port, command, credentials, exception', [
+    ('unknown_host', 22, 'ls -l', {}, BadHostKeyException),
+    ('some_host', 22, 'ls -l', {'password': 'wrong_password'}, BadHostKeyException),
+    ('some_host_2', 4826, 'ls -l', {}, NotImplementedError),
+    ('some_host_3', 22, 'other_command --param1 value1', {}, NotImplementedError),
+    ('some_host_3', 22, 'custom_command_2 --param1 value1', {}, NotImplementedError)
+])
+def test_failures(mock_environ, host, port, command, credentials, exception):
+    with pytest.raises(exception):
+        _run(host, port, command, **credentials)
+
+def test_append_and_remove_stdout(register_host):
+    ls_command = SSHCommandMock('', 'file_1\n', '')
+    for index in range(2, 5):
+        ls_command.append_to_stdout(f'file_{index}\n')
+    ls_command.remove_line_containing('file_3')
+    register_host('stdout_host', 22, {
+        'ls -l': ls_command
+    }, 'root', 'root')
+    output = _run('stdout_host', 22, 'ls -l')
+    assert output == 'file_1\nfile_2\nfile_4\n'
+
+def test_cleanup_environment(cleaned_environ):
+    cleaned_environ.add_responses_for_host('cleanup_host', 22, {
         'ls -l': SSHCommandMock('', 'ls output', '')
     }, 'root', 'root')
-    with patch('paramiko.SSHClient', new=SSHClientMock): 
-        output = example_function_1()
-        assert output == 'ls output'
-
-def test_example_function_2():
-    ssh_mock = SSHClientMock()
-    SSHMockEnvron().add_responses_for_host('some_host_2', 4826, {
-        'sudo docker ps': SSHCommandMock('', 'docker-ps-output', '')
+    assert _run('cleanup_host', 22, 'ls -l') == 'ls output'
+    cleaned_environ.cleanup_environment()
+    with pytest.raises(BadHostKeyException):
+        _connect('cleanup_host', 22)
+
+def test_regexp_command_with_backreference(register_host):
+    # backreferences are not supported by RE2 and use the re module instead
+    register_host('regexp_backreference_host', 22, {
+        r're(custom_command --(\w+) \1)': SSHCommandMock('', 'same value', ''),
+        r're(custom_command .*)': SSHCommandMock('', 'other value', '')
     }, 'root', 'root')
-    # patch the paramiko.SSHClient with the mock
-    with patch('paramiko.SSHClient', new=SSHClientMock): 
-        output = example_function_2()
-        assert output == 'docker-ps-output'
-
-def test_example_function_3():
-    # We can also use a custom command processor
-    def custom_command_processor(ssh_client_mock: SSHClientMock, command: str):
-        # Parse the command and do something with it
-        if 'param1' in command and 'value1' in command:
-            return StringIO(''), StringIO('value1'), StringIO('')
-    
-    # You can use a regexp expresion to match the command with the custom processor
-    ssh_mock = SSHClientMock()
-    SSHMockEnvron().add_responses_for_host('some_host_3', 22, {
-        r're(custom_command .*)': SSHCommandFunctionMock(custom_command_processor) # This is a regexp command
+    assert _run('regexp_backreference_host', 22, 'custom_command --value value') == 'same value'
+    assert _run('regexp_backreference_host', 22, 'custom_command --param1 value1') == 'other value'
+
+def test_regexp_commands_with_flags_and_group_names(register_host):
+    register_host('regexp_flags_host', 22, {
+        r're(other_command (?P<param>--\w+))': SSHCommandMock('', 'other value', ''),
+        r're(unknown_command (?P<param>--\w+))': SSHCommandMock('', 'unknown value', ''),
+        r're((?i)CUSTOM_COMMAND .*)': SSHCommandMock('', 'custom value', '')
     }, 'root', 'root')
-    # patch the paramiko.SSHClient with the mock
-    with patch('paramiko.SSHClient', new=SSHClientMock): 
-        output = example_function_3()
-        assert output == 'value1'
-
-def test_example_function_verify_commands_were_called():
-    ssh_mock = SSHClientMock()
-    SSHMockEnvron().add_responses_for_host('some_host', 22, {
-        're(ls.*)': SSHCommandMock('', 'ls output', '')
+    assert _run('regexp_flags_host', 22, 'unknown_command --param1') == 'unknown value'
+    assert _run('regexp_flags_host', 22, 'custom_command --param1 value1') == 'custom value'
+
+def test_regexp_command_with_conditional(register_host):
+    register_host('regexp_conditional_host', 22, {
+        r're(ls .*)': SSHCommandMock('', 'ls output', ''),
+        r're((a)?(?(1)b|c))': SSHCommandMock('', 'conditional output', '')
     }, 'root', 'root')
-    with patch('paramiko.SSHClient', new=SSHClientMock):
-        example_function_multiple_calls()
-        assert 'ls -l' == ssh_mock.called[0]
-        assert 'ls -al' == ssh_mock.called[1]
+    assert _run('regexp_conditional_host', 22, 'ab') == 'conditional output'
+    assert _run('regexp_conditional_host', 22, 'c') == 'conditional output'
 
-def test_example_function_sftp_write():
-    ssh_mock = SSHClientMock()
+def test_regexp_commands_with_generated_group_names(register_host):
+    register_host('regexp_group_name_host', 22, {
+        r're(c)': SSHCommandMock('', 'c output', ''),
+        r're(a(?P<_re1>b))': SSHCommandMock('', 'ab output', '')
+    }, 'root', 'root')
+    assert _run('regexp_group_name_host', 22, 'c') == 'c output'
+    assert _run('regexp_group_name_host', 22, 'ab') == 'ab output'
 
-    SSHMockEnvron().add_responses_for_host('some_host_4', 22, {
-        'ls -l': SSHCommandMock('', 'ls output', '')
+def test_regexp_commands_with_re2(monkeypatch, register_host):
+    re2 = pytest.importorskip('re2')
+    if not hasattr(re2, 'Options'):
+        pytest.skip('google-re2 is not installed')
+    monkeypatch.setattr(_ENVIRON, 'use_re2', True)
+    register_host('regexp_re2_host', 22, {
+        r're(ls -l .*)': SSHCommandMock('', 'ls output', ''),
+        r're(ps (?P<option>\w+))': SSHCommandMock('', 'ps output', ''),
+        r're(custom_command --value (\w+) \1)': SSHCommandMock('', 'same value', '')
+    }, 'root', 'root')
+    assert _run('regexp_re2_host', 22, 'ls -l /tmp') == 'ls output'
+    assert _run('regexp_re2_host', 22, 'ps aux') == 'ps output'
+    assert _run('regexp_re2_host', 22, 'custom_command --value value value') == 'same value'
+    # RE2 only matches ASCII word characters, the re module would match this one
+    with pytest.raises(NotImplementedError):
+        _run('regexp_re2_host', 22, 'ps é')
+
+def test_commands_added_after_registering(register_host):
+    responses = {'ls -l': SSHCommandMock('', 'ls output', '')}
+    register_host('late_commands_host', 22, responses, 'root', 'root')
+    responses['pwd'] = SSHCommandMock('', '/root', '')
+    responses['re(ps.*)'] = SSHCommandMock('', 'ps output', '')
+    assert _run('late_commands_host', 22, 'pwd') == '/root'
+    assert _run('late_commands_host', 22, 'ps aux') == 'ps output'
+
+def test_patch_client_method(mock_environ):
+    client = _connect('some_host', 22)
+    with mock.patch.object(client, 'exec_command', return_value=(None, None, None)) as exec_command:
+        client.exec_command('ls -l')
+    exec_command.assert_called_once_with('ls -l')
+
+def test_regexp_command_replaced_after_registering(register_host):
+    responses = {'re(ls.*)': SSHCommandMock('', 'ls output', '')}
+    register_host('replaced_regexp_host', 22, responses, 'root', 'root')
+    assert _run('replaced_regexp_host', 22, 'ls -l') == 'ls output'
+    responses['re(ls.*)'] = SSHCommandMock('', 'new ls output', '')
+    register_host('replaced_regexp_host', 22, responses, 'root', 'root')
+    assert _connect('replaced_regexp_host', 22).exec_command('ls -l')[1].read() == 'new ls output'
+
+class _Command(str):
+    pass
+
+def test_str_subclass_commands(register_host):
+    register_host('str_subclass_host', 22, {
+        _Command('ls -l'): SSHCommandMock('', 'ls output', '')
     }, 'root', 'root')
-    # patch the paramiko.SSHClient with the mock
-    with patch('paramiko.SSHClient', new=SSHClientMock): 
-        example_function_sftp_write()
-        assert 'Something to put in the remote file' == ssh_mock.sftp_client_mock.sftp_file_mock.written[0]
+    assert _run('str_subclass_host', 22, _Command('ls -l')) == 'ls output'
 
-def test_example_function_sftp_read():
-    ssh_mock = SSHClientMock()
+def test_wrong_password_after_connecting(mock_environ):
+    assert _run('some_host', 22, 'ls -l') == 'ls output'
+    with pytest.raises(BadHostKeyException):
+        _run('some_host', 22, 'ls -l', password='wrong')
 
-    SSHMockEnvron().add_responses_for_host('some_host_4', 22, {
+def test_remove_responses_for_host():
+    _ENVIRON.add_responses_for_host('removed_host', 22, {
         'ls -l': SSHCommandMock('', 'ls output', '')
     }, 'root', 'root')
-    ssh_mock.sftp_client_mock.sftp_file_mock.file_content = 'Something from the remote file'
-    # patch the paramiko.SSHClient with the mock
-    with patch('paramiko.SSHClient', new=SSHClientMock): 
-        output = example_function_sftp_read()
-        assert 'Something from the remote file' == output
\ No newline at end of file
+    assert _run('removed_host', 22, 'ls -l') == 'ls output'
+    _ENVIRON.remove_responses_for_host('removed_host', 22)
+    with pytest.raises(BadHostKeyException):
+        _connect('removed_host', 22)